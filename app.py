@@ -2,7 +2,216 @@ import streamlit as st
 from streamlit_cropper import st_cropper
 from PIL import Image, ImageDraw, ImageOps
 import io
+import multiprocessing
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
 import zipfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from image_ops import SAVE_OPTS, _rotate, _rotated_size, crop_worker, rotated_crop, to_save_mode
+
+# Optional: libvips is much faster than Pillow on large images
+try:
+    import pyvips
+    HAVE_VIPS = True
+except ImportError:
+    HAVE_VIPS = False
+
+
+JPEGTRAN = shutil.which("jpegtran")
+PREVIEW_MAX_SIDE = 1200
+REF_DRAFT_SIDE = 1600
+_buffers = threading.local()
+
+
+def _scratch_buffer():
+    """Per-thread BytesIO, emptied and reused for every image that thread encodes."""
+    buf = getattr(_buffers, "buf", None)
+    if buf is None:
+        buf = _buffers.buf = io.BytesIO()
+    buf.seek(0)
+    buf.truncate(0)
+    return buf
+
+
+def _output_name(name):
+    """`photo.jpg` -> `photo_Cropped.jpg`."""
+    if "." in name:
+        filename, ext_text = name.rsplit(".", 1)
+        ext = f".{ext_text}"
+    else:
+        filename = name
+        ext = ""
+    return f"{filename}_Cropped{ext}"
+
+
+@st.cache_data(show_spinner=False)
+def _build_index(files_key):
+    """Unique label -> position in the upload list, from (name, file_id) pairs.
+
+    Repeated filenames get " (2)", " (3)", ... before the extension so none are dropped.
+    """
+    index = {}
+    for i, (name, _file_id) in enumerate(files_key):
+        stem, dot, ext = name.rpartition(".")
+        if not dot:
+            stem, ext = name, ""
+        label, n = name, 1
+        while label in index:
+            n += 1
+            label = f"{stem} ({n}){dot}{ext}"
+        index[label] = i
+    return index
+
+
+def _detect_fmt(file):
+    """Pillow save format for an uploaded file, from its MIME type."""
+    fmt = file.type.split('/')[-1].upper() if file.type else 'PNG'
+    if fmt == 'JPG': fmt = 'JPEG'
+    return fmt
+
+
+def _jpeg_imcu(img):
+    """(width, height) of a JPEG's iMCU, the block grid jpegtran snaps crop origins to."""
+    layers = getattr(img, "layer", None) or []
+    if len(layers) <= 1:
+        return 8, 8
+    return 8 * max(layer[1] for layer in layers), 8 * max(layer[2] for layer in layers)
+
+
+def jpegtran_crop(data: bytes, rect):
+    """Lossless JPEG crop via jpegtran.
+
+    Returns None if jpegtran fails or its output isn't exactly the size of `rect`.
+    """
+    left, top, right, bottom = rect
+    result = subprocess.run(
+        [JPEGTRAN, "-copy", "none", "-crop", f"{right - left}x{bottom - top}+{left}+{top}"],
+        input=data,
+        capture_output=True,
+    )
+    if result.returncode != 0 or not result.stdout:
+        return None
+    # jpegtran silently moves an unaligned origin to the iMCU grid and grows the output
+    with Image.open(io.BytesIO(result.stdout)) as out:
+        if out.size != (right - left, bottom - top):
+            return None
+    return result.stdout
+
+
+def jpeg_window(data: bytes, rect, imcu, size):
+    """Losslessly cut the iMCU-aligned window around `rect` out of a JPEG with jpegtran.
+
+    `imcu` is the file's (width, height) block grid from `_jpeg_imcu` and `size`
+    the full image size. The window keeps one iMCU of margin on each side (where
+    the image allows) so chroma upsampling at the crop edges sees the same
+    neighbours as a full decode.
+    Returns (window image, `rect` relative to the window), or None if jpegtran fails.
+    """
+    left, top, right, bottom = rect
+    mcu_w, mcu_h = imcu
+    x0 = max(0, left - left % mcu_w - mcu_w)
+    y0 = max(0, top - top % mcu_h - mcu_h)
+    x1 = min(size[0], right + mcu_w)
+    y1 = min(size[1], bottom + mcu_h)
+    window = jpegtran_crop(data, (x0, y0, x1, y1))
+    if not window:
+        return None
+    return Image.open(io.BytesIO(window)), (left - x0, top - y0, right - x0, bottom - y0)
+
+
+def crop_bytes_vips(src: bytes, rect, deg, fmt, mirrored=False, save_opts=None):
+    """Mirror/rotate/crop/encode with libvips.
+
+    Returns None for non-right angles or when the box leaves the canvas.
+    """
+    img = pyvips.Image.new_from_buffer(src, "")
+    if mirrored:
+        img = img.fliphor()
+
+    q = deg % 360
+    if q == 90:
+        img = img.rot90()
+    elif q == 180:
+        img = img.rot180()
+    elif q == 270:
+        img = img.rot270()
+    elif q:
+        # libvips' rotate() rounds its canvas differently from Image.rotate(expand=True),
+        # which the crop box is measured on; rotated_crop handles these angles instead
+        return None
+
+    # Pillow pads out-of-bounds crops with black; libvips refuses them, so let Pillow handle it
+    left, top, right, bottom = rect
+    if right > img.width or bottom > img.height:
+        return None
+    img = img.crop(left, top, right - left, bottom - top)
+
+    # Translate the Pillow encoder options into libvips' names.
+    # Drop EXIF/ICC like the Pillow and jpegtran paths do; a kept Orientation
+    # tag would make viewers re-rotate a crop chosen on the raw pixels.
+    save_opts = save_opts or {}
+    vips_opts = {"keep": "none"} if pyvips.at_least_libvips(8, 15) else {"strip": True}
+    if "quality" in save_opts:
+        vips_opts["Q"] = save_opts["quality"]
+    if "subsampling" in save_opts:
+        # libvips' automatic mode turns 4:2:0 off at Q >= 90, so force it to match Pillow
+        vips_opts["subsample_mode"] = "on" if save_opts["subsampling"] == 2 else "off"
+    if "compress_level" in save_opts:
+        vips_opts["compression"] = save_opts["compress_level"]
+    return img.write_to_buffer("." + fmt.lower(), **vips_opts)
+
+
+@st.cache_data(max_entries=8)
+def load_ref(file_bytes: bytes) -> Image.Image:
+    """Decode the reference image once; reruns reuse the cached copy.
+
+    JPEGs are decoded at a reduced DCT scale, since the reference is only shown on screen.
+    """
+    img = Image.open(io.BytesIO(file_bytes))
+    # draft() keeps both sides >= the requested box, so match the box to the aspect ratio
+    s = REF_DRAFT_SIDE / max(img.size)
+    img.draft("RGB", (max(1, int(img.width * s)), max(1, int(img.height * s))))
+    img.load()
+    return img
+
+
+@st.cache_data(max_entries=8)
+def rotated_ref(file_bytes: bytes, angle: int, mirrored: bool = False) -> Image.Image:
+    """Reference image with the sidebar mirror/rotation applied."""
+    img = load_ref(file_bytes)
+    if mirrored:
+        img = ImageOps.mirror(img)
+    return _rotate(img, angle)
+
+
+@st.cache_data(max_entries=8)
+def to_cropper_input(file_bytes: bytes, angle: int, mirrored: bool = False) -> Image.Image:
+    """8-bit RGB copy of a non-RGB reference for st_cropper.
+
+    The cropper serialises its image on every rerun, which is much cheaper
+    for plain RGB than for RGBA, palette or 16-bit images.
+    """
+    return rotated_ref(file_bytes, angle, mirrored).convert("RGB")
+
+
+@st.cache_data(max_entries=32)
+def manual_preview(_img, file_id: str, angle: int, mirrored: bool, rect) -> Image.Image:
+    """Downscaled copy of `_img` with the crop box drawn on it (no box if `rect` is None).
+
+    `_img` isn't hashed; the reference file id and transforms key the cache.
+    """
+    img_w, img_h = _img.size
+    s = min(1.0, PREVIEW_MAX_SIDE / max(img_w, img_h))
+    thumb = _img.resize((max(1, int(img_w * s)), max(1, int(img_h * s))), Image.Resampling.BILINEAR)
+    if rect is not None:
+        scaled_rect = tuple(int(c * s) for c in rect)
+        ImageDraw.Draw(thumb).rectangle(scaled_rect, outline="red", width=max(2, int(5 * s)))
+    return thumb
+
 
 # Page Config
 st.set_page_config(layout="wide", page_title="Batch Image Cropper")
@@ -28,7 +237,8 @@ uploaded_files = st.file_uploader(
 )
 
 if uploaded_files:
-    img_map = {f.name: f for f in uploaded_files}
+    # Cached on (name, file_id), so it survives reruns and keeps duplicate filenames apart
+    img_index = _build_index(tuple((f.name, f.file_id) for f in uploaded_files))
 
     # --- 2. General Settings ---
     st.sidebar.header("⚙️ General Settings")
@@ -36,37 +246,70 @@ if uploaded_files:
     # Reference Image
     ref_img_name = st.sidebar.selectbox(
         "Select Reference Image", 
-        list(img_map.keys()),
+        list(img_index.keys()),
         index=0
     )
-    ref_file = img_map[ref_img_name]
-    raw_image = Image.open(ref_file)
+    ref_file = uploaded_files[img_index[ref_img_name]]
     
     # --- New: Mirror Option ---
     is_mirrored = st.sidebar.checkbox("🪞 Mirror Image (Flip Horizontal)", value=False)
     
     # --- New: Rotation with Number Input ---
-    # Using number_input allows precise entry vs a slider
-    rotate_angle = st.sidebar.number_input(
-        "Rotate (Degrees)", 
-        min_value=-360, 
-        max_value=360, 
-        value=0,
-        step=1
-    )
+    # Using number_input allows precise entry vs a slider.
+    # Inside a form so the reference is only re-rotated when the user applies it.
+    with st.sidebar.form("rot_form"):
+        angle_input = st.number_input(
+            "Rotate (Degrees)", 
+            min_value=-360, 
+            max_value=360, 
+            value=0,
+            step=1
+        )
+        if st.form_submit_button("Apply rotation"):
+            st.session_state["applied_angle"] = angle_input
+    rotate_angle = st.session_state.get("applied_angle", 0)
     
     # --- Apply Transforms to Reference Image ---
-    # 1. Mirror
-    if is_mirrored:
-        processed_image = ImageOps.mirror(raw_image)
-    else:
-        processed_image = raw_image
+    # Cached on the file bytes, so reruns skip the decode, mirror and rotate
+    ref_bytes = ref_file.getvalue()
+    processed_image = rotated_ref(ref_bytes, rotate_angle, is_mirrored)
+
+    # The preview may be a reduced JPEG draft; crop coordinates stay in full resolution
+    with Image.open(io.BytesIO(ref_bytes)) as probe:
+        img_w, img_h = _rotated_size(*probe.size, rotate_angle)
+    scale_x = img_w / processed_image.width
+    scale_y = img_h / processed_image.height
 
-    # 2. Rotate
-    if rotate_angle != 0:
-        processed_image = processed_image.rotate(-rotate_angle, expand=True)
+    # At full resolution the batch can reuse the transformed reference instead of decoding it again
+    decoded_refs = {}
+    if processed_image.size == (img_w, img_h):
+        decoded_refs[ref_file.file_id] = processed_image
 
-    img_w, img_h = processed_image.size
+    def to_preview(box):
+        """Map a full-resolution box onto processed_image."""
+        return (int(box[0] / scale_x), int(box[1] / scale_y), int(box[2] / scale_x), int(box[3] / scale_y))
+
+    # --- Performance ---
+    st.sidebar.divider()
+    st.sidebar.subheader("⚡ Performance")
+    use_multiprocessing = st.sidebar.checkbox(
+        "Use multiprocessing",
+        value=False,
+        help="Crop in separate processes. Faster for many large images, slower to start."
+    )
+    compress_zip = st.sidebar.checkbox(
+        "Compress ZIP (slower)",
+        value=False,
+        help="JPEG/PNG are already compressed, so this rarely shrinks the download."
+    )
+    jpeg_quality = st.sidebar.slider(
+        "JPEG Quality", 50, 100, SAVE_OPTS["JPEG"]["quality"],
+        help="Lower is smaller and faster to encode."
+    )
+    png_level = st.sidebar.slider(
+        "PNG Compression Level", 0, 9, SAVE_OPTS["PNG"]["compress_level"],
+        help="Higher is smaller but slower to encode."
+    )
 
     # --- 3. Crop Method Selection ---
     st.sidebar.divider()
@@ -82,19 +325,25 @@ if uploaded_files:
     if crop_mode == "Draw Box (Mouse)":
         with col1:
             st.subheader("Draw Crop Box")
+            # RGB references go straight in; only other modes need a cached converted copy
+            if processed_image.mode == "RGB":
+                cropper_img = processed_image
+            else:
+                cropper_img = to_cropper_input(ref_bytes, rotate_angle, is_mirrored)
             crop_box = st_cropper(
-                processed_image,
+                cropper_img,
                 realtime_update=True,
                 box_color='#FF0000',
                 return_type='box'
             )
             
-            # Extract coordinates
-            rect_left = int(crop_box['left'])
-            rect_top = int(crop_box['top'])
-            rect_right = int(crop_box['left'] + crop_box['width'])
-            rect_bottom = int(crop_box['top'] + crop_box['height'])
+            # Extract coordinates (scaled from preview back to full resolution)
+            rect_left = int(crop_box['left'] * scale_x)
+            rect_top = int(crop_box['top'] * scale_y)
+            rect_right = int((crop_box['left'] + crop_box['width']) * scale_x)
+            rect_bottom = int((crop_box['top'] + crop_box['height']) * scale_y)
             rect = (rect_left, rect_top, rect_right, rect_bottom)
+            valid = rect[2] > rect[0] and rect[3] > rect[1]
 
     # --- MODE B: MANUAL (Custom) ---
     else:
@@ -112,12 +361,13 @@ if uploaded_files:
             st.form_submit_button("Update Preview")
             
         rect = (m_left, m_top, m_right, m_bottom)
+        valid = rect[2] > rect[0] and rect[3] > rect[1]
 
         with col1:
             st.subheader("Manual Preview")
-            preview_with_box = processed_image.copy()
-            draw = ImageDraw.Draw(preview_with_box)
-            draw.rectangle(rect, outline="red", width=5)
+            # ImageDraw rejects inverted boxes, so only draw one when the coordinates are valid
+            preview_box = to_preview(rect) if valid else None
+            preview_with_box = manual_preview(processed_image, ref_file.file_id, rotate_angle, is_mirrored, preview_box)
             st.image(preview_with_box, width=None, use_container_width=True)
 
     # --- 4. Result Preview ---
@@ -125,9 +375,9 @@ if uploaded_files:
         st.subheader("Crop Result")
         
         # Validation
-        if rect[2] > rect[0] and rect[3] > rect[1]:
-            final_crop = processed_image.crop(rect)
-            st.image(final_crop, caption=f"Size: {final_crop.size}", width=None, use_container_width=True)
+        if valid:
+            final_crop = processed_image.crop(to_preview(rect))
+            st.image(final_crop, caption=f"Size: {(rect[2] - rect[0], rect[3] - rect[1])}", width=None, use_container_width=True)
             st.code(f"L: {rect[0]}\nT: {rect[1]}\nR: {rect[2]}\nB: {rect[3]}")
         else:
             st.warning("Invalid Coordinates! Right must be > Left and Bottom > Top.")
@@ -136,67 +386,143 @@ if uploaded_files:
     st.divider()
     
     if st.button(f"🚀 Crop All {len(uploaded_files)} Images"):
-        # Double check validity before starting loop
-        if rect[2] <= rect[0] or rect[3] <= rect[1]:
+        # Bail out before allocating the archive or progress widgets
+        if not valid:
             st.error("Please select a valid crop area first.")
+            st.stop()
+
+        # Archive spills to disk past 50 MB, so big batches don't sit in RAM
+        zip_buffer = tempfile.SpooledTemporaryFile(max_size=50_000_000)
+        progress_bar = st.progress(0)
+        status_text = st.empty()
+        fmts = {f.file_id: _detect_fmt(f) for f in uploaded_files}
+        out_names = {uploaded_files[i].file_id: _output_name(label) for label, i in img_index.items()}
+        save_opts = {
+            "JPEG": {**SAVE_OPTS["JPEG"], "quality": jpeg_quality},
+            "PNG": {**SAVE_OPTS["PNG"], "compress_level": png_level},
+        }
+        
+        # jpegtran can crop JPEGs without re-encoding when the box sits on the iMCU grid
+        no_transform = rotate_angle % 360 == 0 and not is_mirrored
+        lossless_ok = JPEGTRAN is not None and no_transform
+        crop_area = (rect[2] - rect[0]) * (rect[3] - rect[1])
+
+        def encode(cropped_img, fmt):
+            img_byte_arr = _scratch_buffer()
+            cropped_img = to_save_mode(cropped_img, fmt)
+            cropped_img.save(img_byte_arr, format=fmt, **save_opts.get(fmt, {}))
+            return img_byte_arr.getvalue()
+
+        def process_one(file):
+            out_name = out_names[file.file_id]
+            fmt = fmts[file.file_id]
+
+            # 1. Open Image (header only, pixels are decoded lazily)
+            img = Image.open(file)
+
+            # Nothing to do: copy the original bytes straight into the ZIP
+            if no_transform and rect == (0, 0, img.width, img.height):
+                return out_name, file.getvalue()
+
+            crop_rect = rect
+            jpeg_in_bounds = file.type == 'image/jpeg' and rect[2] <= img.width and rect[3] <= img.height
+
+            # Lossless fast path: skip Pillow's decode/encode entirely
+            if lossless_ok and jpeg_in_bounds:
+                mcu_w, mcu_h = _jpeg_imcu(img)
+                if all(c % mcu_w == 0 for c in rect[::2]) and all(c % mcu_h == 0 for c in rect[1::2]):
+                    payload = jpegtran_crop(file.getvalue(), rect)
+                    if payload:
+                        return out_name, payload
+
+            # Small crop from a big JPEG: only decode the iMCU-aligned window around it
+            window = None
+            if JPEGTRAN and no_transform and jpeg_in_bounds and crop_area < 0.25 * img.width * img.height:
+                window = jpeg_window(file.getvalue(), rect, _jpeg_imcu(img), img.size)
+                if window:
+                    img, crop_rect = window
+
+            # Reference is already decoded, mirrored and rotated at full size.
+            # Checked after the jpegtran paths, which are cheaper than a re-encode.
+            ref_img = decoded_refs.pop(file.file_id, None)
+            if ref_img is not None and not window:
+                return out_name, encode(ref_img.crop(rect), fmt)
+
+            # libvips fast path, falls through to Pillow if it can't handle the box
+            if HAVE_VIPS and not window and rotate_angle % 90 == 0:
+                payload = crop_bytes_vips(file.getvalue(), rect, rotate_angle, fmt, is_mirrored, save_opts.get(fmt))
+                if payload is not None:
+                    return out_name, payload
+
+            # 2. Mirror if checked (Must happen before rotation to match preview)
+            if is_mirrored:
+                img = ImageOps.mirror(img)
+
+            # 3 & 4. Rotate if needed, then Crop
+            cropped_img = rotated_crop(img, rotate_angle, crop_rect)
+
+            # 5. Save to Buffer
+            return out_name, encode(cropped_img, fmt)
+
+        if use_multiprocessing:
+            # Raw bytes in, bytes out, so nothing Pillow-specific gets pickled.
+            # Spawn rather than fork: the Streamlit server is multi-threaded.
+            ex = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+
+            def submit(file):
+                fmt = fmts[file.file_id]
+                task = (out_names[file.file_id], file.getvalue(), rect, rotate_angle, fmt, is_mirrored, save_opts.get(fmt, {}))
+                return ex.submit(crop_worker, task)
         else:
-            zip_buffer = io.BytesIO()
-            progress_bar = st.progress(0)
-            status_text = st.empty()
-            
-            with zipfile.ZipFile(zip_buffer, "w") as zf:
-                for i, file in enumerate(uploaded_files):
+            # Pillow releases the GIL while decoding/encoding, so threads scale
+            # across cores. Only the ZipFile writes stay on this thread.
+            ex = ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 2))
+
+            def submit(file):
+                return ex.submit(process_one, file)
+
+        # JPEG/PNG are already entropy-coded: deflate costs a lot of CPU to save
+        # well under 1%, so entries are stored as-is unless the user opts in.
+        if compress_zip:
+            zip_opts = dict(compression=zipfile.ZIP_DEFLATED, compresslevel=1)
+        else:
+            zip_opts = dict(compression=zipfile.ZIP_STORED)
+
+        # allowZip64 keeps archives over 4 GB valid
+        with zipfile.ZipFile(zip_buffer, "w", allowZip64=True, **zip_opts) as zf, ex:
+            futures = {submit(file): file for file in uploaded_files}
+            # Each widget update is a websocket message, so cap them at ~100 per batch
+            total = len(uploaded_files)
+            step = max(1, total // 100)
+            for i, future in enumerate(as_completed(futures)):
+                # Pop so each cropped payload is freed once it is in the archive
+                file = futures.pop(future)
+                update_ui = (i + 1) % step == 0 or i + 1 == total
+                if update_ui:
                     status_text.text(f"Processing {file.name}...")
-                    try:
-                        # 1. Open Image
-                        img = Image.open(file)
-                        
-                        # 2. Mirror if checked (Must happen before rotation to match preview)
-                        if is_mirrored:
-                            img = ImageOps.mirror(img)
-                        
-                        # 3. Rotate if needed
-                        if rotate_angle != 0:
-                            img = img.rotate(-rotate_angle, expand=True)
-                        
-                        # 4. Crop
-                        cropped_img = img.crop(rect)
-                        
-                        # 5. Save to Buffer
-                        img_byte_arr = io.BytesIO()
-                        
-                        # Determine Format
-                        fmt = file.type.split('/')[-1].upper() if file.type else 'PNG'
-                        if fmt == 'JPG': fmt = 'JPEG'
-                        
-                        cropped_img.save(img_byte_arr, format=fmt)
-                        
-                        # 6. Fix Filename
-                        if "." in file.name:
-                            filename, ext_text = file.name.rsplit(".", 1)
-                            ext = f".{ext_text}"
-                        else:
-                            filename = file.name
-                            ext = ""
-                        
-                        # 7. Write to Zip
-                        zf.writestr(f"{filename}_Cropped{ext}", img_byte_arr.getvalue())
-
-                    except Exception as e:
-                        print(f"Error processing {file.name}: {e}")
-                    
-                    # Update Progress
-                    progress_bar.progress((i + 1) / len(uploaded_files))
-            
-            status_text.success("Processing Complete!")
-            
-            # Download Button
-            st.download_button(
-                label="⬇️ Download ZIP",
-                data=zip_buffer.getvalue(),
-                file_name="batch_cropped.zip",
-                mime="application/zip"
-            )
+                try:
+                    # 7. Write to Zip
+                    zf.writestr(*future.result())
+
+                except Exception as e:
+                    print(f"Error processing {file.name}: {e}")
+
+                # Update Progress
+                if update_ui:
+                    progress_bar.progress((i + 1) / total)
+        
+        status_text.success("Processing Complete!")
+        
+        # Download Button (needs bytes, so read the archive and release the temp file)
+        zip_buffer.seek(0)
+        zip_data = zip_buffer.read()
+        zip_buffer.close()
+        st.download_button(
+            label="⬇️ Download ZIP",
+            data=zip_data,
+            file_name="batch_cropped.zip",
+            mime="application/zip"
+        )
 
 else:
     st.info("👆 Please upload images to begin.")
@@ -0,0 +1,100 @@
+"""Pillow-only crop helpers.
+
+Kept out of app.py so ProcessPoolExecutor workers can import them without
+running the Streamlit script.
+"""
+import io
+import math
+
+from PIL import Image, ImageOps
+
+# Explicit encoder settings; Pillow's defaults (PNG compress_level=6) are slow
+SAVE_OPTS = {
+    "JPEG": dict(quality=90, optimize=False, progressive=False, subsampling=2),
+    "PNG": dict(compress_level=1, optimize=False),
+}
+
+
+def _rotate(img, deg):
+    """Rotate clockwise by `deg`, using lossless transposes for right angles."""
+    q = deg % 360
+    if q == 0:
+        return img
+    if q == 90:
+        return img.transpose(Image.Transpose.ROTATE_270)
+    if q == 180:
+        return img.transpose(Image.Transpose.ROTATE_180)
+    if q == 270:
+        return img.transpose(Image.Transpose.ROTATE_90)
+    return img.rotate(-deg, expand=True)
+
+
+def _rotation_matrix(w, h, deg):
+    """Output->source affine terms (cos, sin, x offset, y offset) that Image.rotate builds."""
+    rad = math.radians(deg)
+    cos_a, sin_a = round(math.cos(rad), 15), round(math.sin(rad), 15)
+    cx, cy = w / 2.0, h / 2.0
+    c = cx - cos_a * cx - sin_a * cy
+    f = cy + sin_a * cx - cos_a * cy
+    return cos_a, sin_a, c, f
+
+
+def _rotated_size(w, h, deg):
+    """Size of a `w` x `h` image after `_rotate(img, deg)`."""
+    q = deg % 360
+    if q in (0, 180):
+        return w, h
+    if q in (90, 270):
+        return h, w
+    cos_a, sin_a, c, f = _rotation_matrix(w, h, deg)
+    xx = [cos_a * x + sin_a * y + c for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    yy = [-sin_a * x + cos_a * y + f for x, y in ((0, 0), (w, 0), (w, h), (0, h))]
+    return math.ceil(max(xx)) - math.floor(min(xx)), math.ceil(max(yy)) - math.floor(min(yy))
+
+
+def rotated_crop(img, deg, rect):
+    """Equivalent to `_rotate(img, deg).crop(rect)`, but only samples the pixels inside `rect`.
+
+    Output can differ from the two-step version by a single source pixel where
+    nearest-neighbour sampling lands exactly on a pixel edge.
+    """
+    if deg % 90 == 0:
+        return _rotate(img, deg).crop(rect)
+
+    w, h = img.size
+    cos_a, sin_a, c, f = _rotation_matrix(w, h, deg)
+    nw, nh = _rotated_size(w, h, deg)
+
+    # Shift the origin to the expanded canvas, then to the crop's top-left corner
+    left, top, right, bottom = rect
+    dx, dy = left - (nw - w) / 2.0, top - (nh - h) / 2.0
+    matrix = (
+        cos_a, sin_a, cos_a * dx + sin_a * dy + c,
+        -sin_a, cos_a, -sin_a * dx + cos_a * dy + f,
+    )
+    return img.transform((right - left, bottom - top), Image.Transform.AFFINE, matrix)
+
+
+def to_save_mode(img, fmt):
+    """Convert RGBA/palette images to RGB when writing JPEG, which can't store them."""
+    if fmt == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+        return img.convert("RGB")
+    return img
+
+
+def crop_worker(args):
+    """Process-pool task: (name, data, rect, deg, fmt, mirrored, save_opts) -> (name, encoded bytes).
+
+    Takes and returns raw bytes so only plain data is pickled between processes.
+    """
+    name, data, rect, deg, fmt, mirrored, save_opts = args
+    img = Image.open(io.BytesIO(data))
+    # Nothing to do: return the original bytes untouched
+    if not mirrored and deg % 360 == 0 and tuple(rect) == (0, 0, img.width, img.height):
+        return name, data
+    if mirrored:
+        img = ImageOps.mirror(img)
+    cropped_img = to_save_mode(rotated_crop(img, deg, rect), fmt)
+    buf = io.BytesIO()
+    cropped_img.save(buf, format=fmt, **save_opts)
+    return name, buf.getvalue()